@@ -0,0 +1,244 @@
+"""
+This module implements a nearest-neighbour index over real car listings.
+
+The index lets the application show the listings most similar to the car for
+which a user requested a price. Listings are compared in the feature space of
+the model: scaled numeric inputs, boolean inputs and learned embeddings,
+optionally followed by the visual features of their images.
+
+The index is built offline and can be used as a stand-alone script:
+
+    python3 -m src.app.comparables --dir models --output models/comparables-index.npz
+"""
+
+import argparse
+import hashlib
+import os
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# The default location of the index, relative to the root of the repository.
+DEFAULT_INDEX_PATH = os.path.join("models", "comparables-index.npz")
+
+# The listing columns stored alongside the features, and their names in the
+# results of a query.
+LISTING_COLUMNS = {
+    "Url": "url",
+    "Autovit Id": "id",
+    "Pret (EUR)": "price",
+    "Marca": "brand",
+    "Model": "model",
+    "Anul": "year",
+    "Km": "km",
+}
+
+
+def model_fingerprint(model_name: str, helper_filename: str, dir: str) -> str:
+    """
+    Compute a hash which identifies a model: its state dict and its helper, as
+    stored on disk.
+    """
+    digest = hashlib.sha256()
+    for filename in (f"{model_name}-statedict.pt", helper_filename):
+        with open(os.path.join(dir, filename), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class ComparablesIndex:
+    """
+    An exact nearest-neighbour index which uses vectorized brute-force search.
+
+    The dataset holds around ten thousand listings, so a single matrix-vector
+    product answers a query in well under a millisecond, without the
+    approximation errors of tree or IVF structures.
+
+    The features only make sense for the model which computed them, so the
+    index also records the name and the fingerprint of that model.
+    """
+
+    def __init__(
+        self,
+        features: np.ndarray,
+        listings: Dict[str, np.ndarray],
+        visual: bool,
+        model_name: str = "",
+        fingerprint: str = "",
+    ):
+        self.features = features.astype(np.float32)
+        self.listings = listings
+        self.visual = visual
+        self.model_name = model_name
+        self.fingerprint = fingerprint
+
+        # Squared norms are cached, because the distances are computed as
+        # |x|^2 - 2 x.q + |q|^2.
+        self.sq_norms = np.einsum("ij,ij->i", self.features, self.features)
+
+    def __len__(self):
+        return len(self.features)
+
+    def query(self, features: np.ndarray, k: int = 5) -> List[Dict[str, Any]]:
+        """Find the `k` listings closest to a single feature vector."""
+        query = features.astype(np.float32).reshape(-1)
+        assert query.shape[0] == self.features.shape[1], "feature sizes differ"
+
+        sq_dists = self.sq_norms - 2 * (self.features @ query) + query @ query
+        k = max(1, min(k, len(self)))
+
+        # Only the best `k` candidates have to be sorted.
+        best = np.argpartition(sq_dists, k - 1)[:k]
+        best = best[np.argsort(sq_dists[best])]
+
+        return [
+            {
+                **{name: values[i].item() for name, values in self.listings.items()},
+                "distance": float(np.sqrt(max(sq_dists[i], 0))),
+            }
+            for i in best
+        ]
+
+    def save(self, path: str) -> None:
+        """Save the index to disk, in a compressed format."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(
+            path,
+            features=self.features,
+            visual=np.array(self.visual),
+            model_name=np.array(self.model_name),
+            fingerprint=np.array(self.fingerprint),
+            **{f"listing_{name}": values for name, values in self.listings.items()},
+        )
+        print(f"Saved the index of {len(self)} listings to '{path}'")
+
+    @staticmethod
+    def load(path: str) -> "ComparablesIndex":
+        """Load an index from disk."""
+        with np.load(path) as data:
+            listings = {
+                key[len("listing_"):]: data[key]
+                for key in data.files
+                if key.startswith("listing_")
+            }
+            # Indexes saved before fingerprints were recorded never match a model.
+            return ComparablesIndex(
+                data["features"],
+                listings,
+                bool(data["visual"]),
+                model_name=str(data["model_name"]) if "model_name" in data.files else "",
+                fingerprint=str(data["fingerprint"]) if "fingerprint" in data.files else "",
+            )
+
+    def matches(self, model_name: str, fingerprint: str) -> bool:
+        """Check whether the index was built with the given model."""
+        return self.model_name == model_name and self.fingerprint == fingerprint
+
+
+def build_index(wrapper, df: "pd.DataFrame", image_dir: Optional[str] = None) -> ComparablesIndex:
+    """
+    Build an index over the listings of a dataframe, using the feature space of
+    the model inside the given wrapper.
+
+    If `image_dir` is given, the visual features of every listing are included
+    and listings without an image are skipped.
+    """
+    # These are only needed offline, so the application does not import them.
+    import torch
+    from PIL import Image
+
+    from src import simplemodel
+
+    if image_dir is not None:
+        paths = [
+            os.path.join(image_dir, str(id), f"{id}.webp")
+            for id in df["Autovit Id"]
+        ]
+        df = df[[os.path.isfile(path) for path in paths]]
+
+    inputs, indices = simplemodel.make_inputs(
+        wrapper.input_helper,
+        df[wrapper.COLS_TO_SCALE],
+        df[wrapper.COLS_NORMAL],
+        df[wrapper.COLS_TO_EMBED],
+    )
+
+    with torch.no_grad():
+        features = wrapper.model.embed(inputs, indices)
+
+        if image_dir is not None:
+            # Process images in chunks, to avoid loading all of them at once.
+            CHUNK_SIZE = 256
+            ids = df["Autovit Id"].tolist()
+            visual_features = []
+            for start in range(0, len(ids), CHUNK_SIZE):
+                images = torch.stack([
+                    wrapper.image_transforms(Image.open(
+                        os.path.join(image_dir, str(id), f"{id}.webp")))
+                    for id in ids[start:start+CHUNK_SIZE]
+                ])
+                visual_features.append(wrapper.model.conv(images))
+            features = torch.hstack((features, torch.vstack(visual_features)))
+
+    # Text columns are stored as fixed-width strings, so that loading the index
+    # does not require unpickling.
+    listings = {
+        name: np.asarray(df[col].to_numpy(), dtype=None if df[col].dtype.kind in "biuf" else str)
+        for col, name in LISTING_COLUMNS.items()
+    }
+    return ComparablesIndex(
+        features.numpy(),
+        listings,
+        visual=image_dir is not None,
+        model_name=wrapper.model_name,
+        fingerprint=model_fingerprint(wrapper.model_name, wrapper.helper_filename, wrapper.dir),
+    )
+
+
+def main() -> None:
+    """Build the index from the command line."""
+    import pandas as pd
+
+    from src.utils import inlier_mask
+
+    from . import simplemodel_wrapper, visualmodel_wrapper
+
+    # Parse command line arguments.
+    parser = argparse.ArgumentParser(description="Comparable listings index builder")
+    parser.add_argument(
+        "--data", help="The CSV file with listings", type=str,
+        default=os.path.join("data", "carsWithImageCleaned.csv"))
+    parser.add_argument(
+        "--dir", help="The directory of the model", type=str, default="models")
+    parser.add_argument(
+        "--model-name", help="The name of the model", type=str, default="visualmodel")
+    parser.add_argument(
+        "--helper", help="The filename of the model helper", type=str,
+        default="visualmodel-helper.pkl")
+    parser.add_argument(
+        "--simple", help="The model is a simple model, not a visual one",
+        action="store_true")
+    parser.add_argument(
+        "--image-dir", help="Also index the visual features of these images",
+        type=str, default=None)
+    parser.add_argument(
+        "--output", help="The path of the index", type=str,
+        default=DEFAULT_INDEX_PATH)
+    args = parser.parse_args()
+
+    module = simplemodel_wrapper if args.simple else visualmodel_wrapper
+    wrapper = module.Wrapper(args.model_name, args.helper, args.dir)
+
+    # Skip the same price outliers which are skipped during training.
+    df = pd.read_csv(args.data, index_col=0)
+    df = df.drop(df[~inlier_mask(df["Pret (EUR)"])].index)
+
+    index = build_index(wrapper, df, args.image_dir)
+    index.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
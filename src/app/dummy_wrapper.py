@@ -5,6 +5,8 @@ This wrapper allows you to test the rest of the implementation without loading
 a real model.
 """
 
+from typing import List
+
 from .model_input import ModelInput
 
 
@@ -20,3 +22,7 @@ class DummyWrapper:
         if inputs.no_accident:
             price *= 2
         return price
+
+    def predict_many(self, inputs: List[ModelInput]):
+        """Make random price predictions for many inputs."""
+        return [self.predict(x) for x in inputs]
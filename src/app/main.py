@@ -2,16 +2,21 @@
 This module implements a web application for making car price predictions.
 """
 
-from typing import Optional
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
 
 from PIL import Image
-from flask import Flask, Request, render_template, request
+from flask import Flask, Request, jsonify, render_template, request
 
-from . import visualmodel_wrapper
+from . import comparables, sweep, visualmodel_wrapper
 from .model_input import ModelInput
 
 app = Flask(__name__)
 
+# The number of comparable listings shown next to a prediction.
+COMPARABLES_SHOWN = 5
+
 
 def load_the_model() -> None:
     """Load into memory *globally* the model used to make predictions."""
@@ -26,6 +31,65 @@ def load_the_model() -> None:
     print("Done loading the model.")
 
 
+def load_the_index() -> None:
+    """
+    Load into memory *globally* the index of comparable listings, if built.
+
+    The index is only used if it was built with the loaded model, since the
+    features of another model are not comparable.
+    """
+    global model, comparables_index
+
+    comparables_index = None
+    path = comparables.DEFAULT_INDEX_PATH
+    if not os.path.isfile(path):
+        return
+
+    index = comparables.ComparablesIndex.load(path)
+    fingerprint = comparables.model_fingerprint(model.model_name, model.helper_filename, model.dir)
+    if not index.matches(model.model_name, fingerprint):
+        print(
+            f"The index at '{path}' was not built with model '{model.model_name}', "
+            "so comparable listings are disabled. Rebuild it to enable them."
+        )
+        return
+
+    comparables_index = index
+    print(f"Done loading the index of {len(comparables_index)} listings.")
+
+
+def find_comparables(features, k: int) -> List[Dict[str, Any]]:
+    """
+    Find the real listings closest to the given feature vector.
+
+    Comparable listings are only a complement to the prediction, so errors are
+    logged instead of failing the request.
+    """
+    global comparables_index
+    if comparables_index is None:
+        return []
+
+    try:
+        return comparables_index.query(features, k)
+    except Exception:
+        app.logger.exception("Could not find comparable listings")
+        return []
+
+
+def predict_with_comparables(model_input: ModelInput, k: int) -> Tuple[float, List[Dict[str, Any]]]:
+    """
+    Make a price prediction and find comparable listings, processing the input
+    only once.
+    """
+    global model, comparables_index
+    if comparables_index is None:
+        return make_prediction(model_input), []
+
+    predictions, features = model.predict_with_features(
+        [model_input], include_visual=comparables_index.visual)
+    return predictions[0], find_comparables(features[0], k)
+
+
 def make_prediction(model_input: ModelInput) -> float:
     global model
     return model.predict(model_input)
@@ -65,18 +129,52 @@ def parse_request(request: Request) -> ModelInput:
 
 
 @app.route("/")
-def index(form=None, prediction: Optional[float] = None):
-    return render_template("index.html", form=form, prediction=prediction)
+def index(form=None, prediction: Optional[float] = None, similar: Optional[list] = None):
+    return render_template("index.html", form=form, prediction=prediction, similar=similar)
 
 
 @app.route("/predict", methods=["POST"])
 def predict():
     model_input = parse_request(request)
-    prediction = make_prediction(model_input)
+    prediction, similar = predict_with_comparables(model_input, COMPARABLES_SHOWN)
+
+    return index(form=request.form, prediction=prediction, similar=similar)
+
+
+@app.route("/comparables", methods=["POST"])
+def similar_listings():
+    """Return the real listings most similar to the submitted car."""
+    model_input = parse_request(request)
+    try:
+        k = max(1, int(request.form.get("k", COMPARABLES_SHOWN)))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    _, similar = predict_with_comparables(model_input, k)
+    return jsonify(similar)
+
+
+@app.route("/sweep", methods=["POST"])
+def price_sweep():
+    """
+    Price many variations of the submitted car in a single batch.
+
+    Besides the usual form, the request must contain a `sweep` field with a JSON
+    object mapping input names to lists of values or to ranges, such as
+    `{"km": {"start": 100000, "stop": 200000, "step": 50000}, "service_book": [false, true]}`.
+    """
+    global model
+    model_input = parse_request(request)
+    try:
+        spec = json.loads(request.form["sweep"])
+        result = sweep.run_sweep(model, model_input, spec)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify(error=str(e)), 400
 
-    return index(form=request.form, prediction=prediction)
+    return jsonify(result)
 
 
 if __name__ == "__main__":
     load_the_model()
+    load_the_index()
     app.run(host="0.0.0.0", debug=True)
@@ -5,7 +5,10 @@ The wrapper adapts the simple model to the interface of the web application,
 allowing you to make predictions with it inside the app.
 """
 
-import pandas as pd
+from typing import List, Tuple
+
+import numpy as np
+import torch
 
 from src import simplemodel
 from src.utils import load_model_helper, load_model_weights
@@ -31,11 +34,37 @@ class Wrapper:
         "Marca", "Model", "Combustibil", "Cutie de viteze",
         "Tip Caroserie", "Culoare", "Tractiune",
     ]
+
+    # The fields of `ModelInput` which hold the values of each column.
+    FIELDS = {
+        "Anul": "year",
+        "Km": "km",
+        "Putere (CP)": "power",
+        "Capacitate cilindrica (cm3)": "cylinder_cap",
+        "Numar de portiere": "doors",
+        "Consum (l/100km)": "consumption",
+        "Fara accident in istoric": "no_accident",
+        "Carte de service": "service_book",
+        "Filtru de particule": "particle_filter",
+        "Inmatriculat": "matriculated",
+        "Primul proprietar": "first_owner",
+        "Marca": "brand",
+        "Model": "model",
+        "Combustibil": "fuel",
+        "Cutie de viteze": "gearbox",
+        "Tip Caroserie": "body",
+        "Culoare": "color",
+        "Tractiune": "drivetrain",
+    }
+
     EMBEDDING_DIM = 4
     HIDDEN_SIZES = [113, 25]
 
     def __init__(self, model_name: str, helper_filename: str, dir: str):
         """Load the given model and helper from disk."""
+        self.model_name = model_name
+        self.helper_filename = helper_filename
+        self.dir = dir
         self.input_helper = load_model_helper(helper_filename, dir)
 
         self.model = simplemodel.SimpleModel(
@@ -47,36 +76,47 @@ class Wrapper:
         load_model_weights(self.model, model_name, dir)
         self.model.eval()
 
-    def predict(self, model_inputs: ModelInput) -> float:
-        """Make a price prediction for the given inputs."""
-        df = pd.DataFrame({
-            "Anul": [model_inputs.year],
-            "Km": [model_inputs.km],
-            "Putere (CP)": [model_inputs.power],
-            "Capacitate cilindrica (cm3)": [model_inputs.cylinder_cap],
-            "Numar de portiere": [model_inputs.doors],
-            "Consum (l/100km)": [model_inputs.consumption],
-            "Fara accident in istoric": [model_inputs.no_accident],
-            "Carte de service": [model_inputs.service_book],
-            "Filtru de particule": [model_inputs.particle_filter],
-            "Inmatriculat": [model_inputs.matriculated],
-            "Primul proprietar": [model_inputs.first_owner],
-            "Marca": [model_inputs.brand],
-            "Model": [model_inputs.model],
-            "Combustibil": [model_inputs.fuel],
-            "Cutie de viteze": [model_inputs.gearbox],
-            "Tip Caroserie": [model_inputs.body],
-            "Culoare": [model_inputs.color],
-            "Tractiune": [model_inputs.drivetrain],
-        })
-
-        inputs, indices = simplemodel.make_inputs(
+    def make_tensors(self, model_inputs: List[ModelInput]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Convert the given inputs into tensors accepted by the model."""
+        def column(col: str) -> list:
+            return [getattr(x, Wrapper.FIELDS[col]) for x in model_inputs]
+
+        return simplemodel.make_inputs_from_lists(
             self.input_helper,
-            df[Wrapper.COLS_TO_SCALE],
-            df[Wrapper.COLS_NORMAL],
-            df[Wrapper.COLS_TO_EMBED]
+            {col: column(col) for col in Wrapper.COLS_TO_SCALE},
+            {col: column(col) for col in Wrapper.COLS_NORMAL},
+            {col: column(col) for col in Wrapper.COLS_TO_EMBED},
         )
 
-        prediction = self.model(inputs, indices).item()
-        prediction *= self.input_helper.maxes["Pret (EUR)"]
-        return prediction
+    def predict(self, model_inputs: ModelInput) -> float:
+        """Make a price prediction for the given inputs."""
+        return self.predict_many([model_inputs])[0]
+
+    def predict_many(self, model_inputs: List[ModelInput]) -> List[float]:
+        """Make price predictions for many inputs in a single forward pass."""
+        return self.predict_with_features(model_inputs)[0]
+
+    def predict_with_features(
+        self,
+        model_inputs: List[ModelInput],
+        include_visual: bool = False,
+    ) -> Tuple[List[float], np.ndarray]:
+        """
+        Make price predictions, and also return the feature vectors used to
+        search for comparable listings, processing the inputs only once.
+
+        The feature vectors are the scaled inputs and the learned embeddings.
+        """
+        assert not include_visual, "this model does not use images"
+
+        inputs, indices = self.make_tensors(model_inputs)
+
+        with torch.no_grad():
+            embedded = self.model.embed(inputs, indices)
+            predictions = self.model.hidden_layers(embedded).view(-1)
+        predictions *= self.input_helper.maxes["Pret (EUR)"]
+        return predictions.tolist(), embedded.numpy()
+
+    def features(self, model_inputs: List[ModelInput], include_visual: bool = False) -> np.ndarray:
+        """Compute the feature vectors used to search for comparable listings."""
+        return self.predict_with_features(model_inputs, include_visual)[1]
@@ -0,0 +1,95 @@
+"""
+This module measures how quickly the web application can start serving.
+
+It reports the time needed to import the application, to load the model and to
+make the first prediction, and it checks that the import stays within a time
+budget without pulling in modules which are only needed for training.
+
+Importing `torch` alone takes most of the import time, and varies a lot between
+runs, so the libraries every prediction needs are imported and timed first.
+The budget only applies to the time the application adds on top of them.
+
+It can be used as a stand-alone script, from the root of the repository:
+
+    python3 -m src.app.startup_check --budget 0.5
+"""
+
+import argparse
+import importlib
+import sys
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .model_input import ModelInput
+
+# Modules which should never be imported on the inference-only path.
+TRAINING_ONLY_MODULES = ["pandas", "torchvision", "optuna", "sklearn", "matplotlib"]
+
+# Libraries which the application cannot serve without. They are imported
+# before the application, and their import time is not part of the budget.
+BASE_MODULES = ["numpy", "torch", "PIL.Image"]
+
+# The default budget for the time added by importing the application, in
+# seconds. Flask, the models and the wrappers usually take 0.1-0.15 s, so the
+# budget only fails on real regressions, such as importing pandas.
+DEFAULT_BUDGET = 0.5
+
+
+def example_input() -> "ModelInput":
+    """Build the first example from the web page, with a blank image."""
+    from PIL import Image
+
+    from .model_input import ModelInput
+
+    return ModelInput(
+        image=Image.new("RGB", (220, 220)),
+        year=2019, km=155_000, power=190, cylinder_cap=1998, doors=4, consumption=4.8,
+        no_accident=True, service_book=True, particle_filter=True,
+        matriculated=False, first_owner=False,
+        brand="Audi", model="A5", fuel="Diesel", gearbox="Automata",
+        body="Sedan", color="Maro", drivetrain="Fata",
+    )
+
+
+def main(budget: float) -> bool:
+    """Start the application, report timings and check the budget."""
+    # Nothing from the application is imported before this point, so that its
+    # whole import cost is measured.
+    start = time.perf_counter()
+    for module in BASE_MODULES:
+        importlib.import_module(module)
+    base_imported = time.perf_counter()
+    from . import main as app
+    imported = time.perf_counter()
+    app.load_the_model()
+    loaded = time.perf_counter()
+    app.make_prediction(example_input())
+    predicted = time.perf_counter()
+
+    print(f"Base libraries import time: {base_imported - start:.3f} s")
+    print(f"Application import time:    {imported - base_imported:.3f} s")
+    print(f"Model loading time:         {loaded - imported:.3f} s")
+    print(f"First prediction time:      {predicted - loaded:.3f} s")
+    print(f"Time to first prediction:   {predicted - start:.3f} s")
+
+    ok = True
+    if imported - base_imported > budget:
+        print(f"The application import took longer than the budget of {budget:.3f} s")
+        ok = False
+    if unwanted := [m for m in TRAINING_ONLY_MODULES if m in sys.modules]:
+        print(f"Training-only modules were imported: {', '.join(unwanted)}")
+        ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    # Parse command line arguments.
+    parser = argparse.ArgumentParser(description="Application startup check")
+    parser.add_argument(
+        "--budget", help="The import-time budget of the application, without base libraries, in seconds",
+        type=float,
+        default=DEFAULT_BUDGET)
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args.budget) else 1)
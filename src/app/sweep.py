@@ -0,0 +1,138 @@
+"""
+This module implements "what-if" price sweeps.
+
+A sweep starts from a single input and varies some of its fields over ranges or
+lists of alternative values. Every combination of values becomes a separate
+input, and all of them are priced together in a single batch.
+"""
+
+import dataclasses
+import itertools
+import math
+from typing import Any, Dict, List, Tuple, Union
+
+from .model_input import ModelInput
+
+# The largest number of inputs a single sweep is allowed to produce.
+MAX_SWEEP_SIZE = 1000
+
+# A sweep specification maps field names to either a list of values, or a
+# range given as a dict with the keys "start", "stop" and "step".
+SweepSpec = Dict[str, Union[List[Any], Dict[str, float]]]
+
+
+def field_types() -> Dict[str, type]:
+    """Get the types of the fields of `ModelInput` which can be swept."""
+    return {
+        field.name: field.type
+        for field in dataclasses.fields(ModelInput)
+        if field.name != "image"
+    }
+
+
+def to_bool(name: str, value: Any) -> bool:
+    """Convert a JSON value into a boolean, accepting only booleans."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise ValueError(f"'{name}' only accepts true or false, not {value!r}")
+
+
+def to_float(name: str, value: Any) -> float:
+    """Convert a JSON value into a finite number."""
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"'{name}' only accepts finite numbers, not {value!r}")
+    return number
+
+
+def to_str(name: str, value: Any) -> str:
+    """Convert a JSON value into text, accepting only strings."""
+    if isinstance(value, str):
+        return value
+    raise ValueError(f"'{name}' only accepts text, not {value!r}")
+
+
+def expand_values(name: str, spec: Union[List[Any], Dict[str, float]]) -> List[Any]:
+    """Convert the specification of a single field into a list of values."""
+    types = field_types()
+    if name not in types:
+        raise ValueError(f"cannot sweep over unknown field '{name}'")
+    field_type = types[name]
+
+    if isinstance(spec, dict):
+        if field_type != float:
+            raise ValueError(f"ranges are only supported for numeric fields, not '{name}'")
+        start = to_float(name, spec["start"])
+        stop = to_float(name, spec["stop"])
+        step = to_float(name, spec["step"])
+        if step <= 0:
+            raise ValueError(f"the step of '{name}' must be positive")
+
+        # The range includes its end, which is what users usually expect for
+        # values such as years. Its length is checked before building it.
+        count = max(int((stop - start) / step + 1e-9) + 1, 0)
+        if count > MAX_SWEEP_SIZE:
+            raise ValueError(f"'{name}' has {count} values, but at most {MAX_SWEEP_SIZE} are allowed")
+        values = [start + i*step for i in range(count)]
+    elif isinstance(spec, list):
+        values = spec
+        if len(values) > MAX_SWEEP_SIZE:
+            raise ValueError(f"'{name}' has {len(values)} values, but at most {MAX_SWEEP_SIZE} are allowed")
+    else:
+        raise ValueError(f"'{name}' must be a list of values or a range, not {spec!r}")
+
+    if not values:
+        raise ValueError(f"no values to sweep over for '{name}'")
+    if field_type == bool:
+        return [to_bool(name, value) for value in values]
+    if field_type == float:
+        return [to_float(name, value) for value in values]
+    return [to_str(name, value) for value in values]
+
+
+def expand(base: ModelInput, spec: SweepSpec) -> Tuple[List[str], List[List[Any]], List[ModelInput]]:
+    """
+    Build one input for every combination of the swept values.
+
+    Returns the swept fields, the values of every field, and the inputs. The
+    order of the inputs matches `itertools.product` over the fields, in the
+    order in which they appear in `spec`. All inputs share the image of `base`.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError(f"the sweep must be an object mapping fields to values, not {spec!r}")
+
+    names = list(spec.keys())
+    values = [expand_values(name, spec[name]) for name in names]
+
+    size = 1
+    for field_values in values:
+        size *= len(field_values)
+    if size > MAX_SWEEP_SIZE:
+        raise ValueError(f"the sweep has {size} inputs, but at most {MAX_SWEEP_SIZE} are allowed")
+
+    inputs = [
+        dataclasses.replace(base, **dict(zip(names, combination)))
+        for combination in itertools.product(*values)
+    ]
+    return names, values, inputs
+
+
+def run_sweep(model, base: ModelInput, spec: SweepSpec) -> Dict[str, Any]:
+    """
+    Price every combination of the swept values with a single model call.
+
+    The result contains the swept fields, their values, and the prices as a
+    nested list, with one level of nesting for every field.
+    """
+    names, values, inputs = expand(base, spec)
+    prices = model.predict_many(inputs)
+
+    # Fold the flat list of prices into a grid, starting from the last field.
+    grid: Any = prices
+    for field_values in reversed(values[1:]):
+        n = len(field_values)
+        grid = [grid[i:i+n] for i in range(0, len(grid), n)]
+
+    return {"fields": names, "values": values, "prices": grid}
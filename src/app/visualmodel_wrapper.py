@@ -5,9 +5,11 @@ The wrapper adapts the model to the interface of the web application,
 allowing you to make predictions with it inside the app.
 """
 
-import pandas as pd
+from typing import Dict, List, Tuple
+
+import numpy as np
 import torch
-import torchvision
+from PIL import Image
 
 from src import simplemodel, visualmodel
 from src.utils import load_model_helper, load_model_weights
@@ -33,12 +35,42 @@ class Wrapper:
         "Marca", "Model", "Combustibil", "Cutie de viteze",
         "Tip Caroserie", "Culoare", "Tractiune",
     ]
+
+    # The fields of `ModelInput` which hold the values of each column.
+    FIELDS = {
+        "Anul": "year",
+        "Km": "km",
+        "Putere (CP)": "power",
+        "Capacitate cilindrica (cm3)": "cylinder_cap",
+        "Numar de portiere": "doors",
+        "Consum (l/100km)": "consumption",
+        "Fara accident in istoric": "no_accident",
+        "Carte de service": "service_book",
+        "Filtru de particule": "particle_filter",
+        "Inmatriculat": "matriculated",
+        "Primul proprietar": "first_owner",
+        "Marca": "brand",
+        "Model": "model",
+        "Combustibil": "fuel",
+        "Cutie de viteze": "gearbox",
+        "Tip Caroserie": "body",
+        "Culoare": "color",
+        "Tractiune": "drivetrain",
+    }
+
     EMBEDDING_DIM = 4
     HIDDEN_SIZES = [113, 25]
+
+    # These configure the visual branch, and must match the trained model.
     IMAGE_SIZE = 128
+    CHANNELS = (16, 32)
+    POOL_SIZE = None
 
     def __init__(self, model_name: str, helper_filename: str, dir: str):
         """Load the given model and helper from disk."""
+        self.model_name = model_name
+        self.helper_filename = helper_filename
+        self.dir = dir
         self.input_helper = load_model_helper(helper_filename, dir)
 
         self.model = visualmodel.VisualModel(
@@ -46,53 +78,103 @@ class Wrapper:
             [len(self.input_helper.vocabs[c]) for c in Wrapper.COLS_TO_EMBED],
             Wrapper.EMBEDDING_DIM,
             Wrapper.HIDDEN_SIZES,
+            image_size=Wrapper.IMAGE_SIZE,
+            channels=Wrapper.CHANNELS,
+            pool_size=Wrapper.POOL_SIZE,
         )
         load_model_weights(self.model, model_name, dir)
         self.model.eval()
 
-        self.image_transforms = torchvision.transforms.Compose([
-            torchvision.transforms.Resize(Wrapper.IMAGE_SIZE),
-            torchvision.transforms.CenterCrop(Wrapper.IMAGE_SIZE),
-            torchvision.transforms.ToTensor(),
-        ])
+    def image_transforms(self, image: Image.Image) -> torch.Tensor:
+        """
+        Resize and center-crop an image to the size expected by the model, and
+        convert it into a tensor.
 
-    def predict(self, model_inputs: ModelInput) -> float:
-        """Make a price prediction for the given inputs."""
-        assert model_inputs.image is not None, "you must provide an image"
-
-        df = pd.DataFrame({
-            "Anul": [model_inputs.year],
-            "Km": [model_inputs.km],
-            "Putere (CP)": [model_inputs.power],
-            "Capacitate cilindrica (cm3)": [model_inputs.cylinder_cap],
-            "Numar de portiere": [model_inputs.doors],
-            "Consum (l/100km)": [model_inputs.consumption],
-            "Fara accident in istoric": [model_inputs.no_accident],
-            "Carte de service": [model_inputs.service_book],
-            "Filtru de particule": [model_inputs.particle_filter],
-            "Inmatriculat": [model_inputs.matriculated],
-            "Primul proprietar": [model_inputs.first_owner],
-            "Marca": [model_inputs.brand],
-            "Model": [model_inputs.model],
-            "Combustibil": [model_inputs.fuel],
-            "Cutie de viteze": [model_inputs.gearbox],
-            "Tip Caroserie": [model_inputs.body],
-            "Culoare": [model_inputs.color],
-            "Tractiune": [model_inputs.drivetrain],
-        })
-
-        inputs, indices = simplemodel.make_inputs(
+        This matches the `Resize`, `CenterCrop` and `ToTensor` transforms used
+        during training, without having to import `torchvision` when serving.
+        """
+        size = Wrapper.IMAGE_SIZE
+
+        # Resize the shorter side of the image to the target size.
+        width, height = image.size
+        if width <= height:
+            width, height = size, int(size * height / width)
+        else:
+            width, height = int(size * width / height), size
+        image = image.resize((width, height), Image.BILINEAR)
+
+        left = int(round((width - size) / 2.0))
+        top = int(round((height - size) / 2.0))
+        image = image.crop((left, top, left + size, top + size))
+
+        pixels = torch.tensor(np.asarray(image), dtype=torch.float32) / 255
+        if pixels.ndim == 2:
+            pixels = pixels.unsqueeze(-1)
+        # Images are stored as HWC, but the model expects CHW.
+        return pixels.permute(2, 0, 1).contiguous()
+
+    def make_tensors(self, model_inputs: List[ModelInput]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Convert the given inputs into tensors accepted by the model."""
+        def column(col: str) -> list:
+            return [getattr(x, Wrapper.FIELDS[col]) for x in model_inputs]
+
+        return simplemodel.make_inputs_from_lists(
             self.input_helper,
-            df[Wrapper.COLS_TO_SCALE],
-            df[Wrapper.COLS_NORMAL],
-            df[Wrapper.COLS_TO_EMBED]
+            {col: column(col) for col in Wrapper.COLS_TO_SCALE},
+            {col: column(col) for col in Wrapper.COLS_NORMAL},
+            {col: column(col) for col in Wrapper.COLS_TO_EMBED},
         )
 
-        # The model expects to receive a batch of fixed-sized images.
-        # We need to process our single image and package it as a batch.
-        images = self.image_transforms(model_inputs.image)
-        images = torch.unsqueeze(images, 0)
+    def predict(self, model_inputs: ModelInput) -> float:
+        """Make a price prediction for the given inputs."""
+        return self.predict_many([model_inputs])[0]
+
+    def predict_many(self, model_inputs: List[ModelInput]) -> List[float]:
+        """Make price predictions for many inputs in a single forward pass."""
+        return self.predict_with_features(model_inputs)[0]
+
+    def predict_with_features(
+        self,
+        model_inputs: List[ModelInput],
+        include_visual: bool = False,
+    ) -> Tuple[List[float], np.ndarray]:
+        """
+        Make price predictions, and also return the feature vectors used to
+        search for comparable listings, processing the inputs only once.
+
+        The feature vectors are the scaled inputs and the learned embeddings,
+        optionally followed by the visual features.
+        """
+        inputs, indices = self.make_tensors(model_inputs)
+
+        with torch.no_grad():
+            embedded = self.model.embed(inputs, indices)
+            all_inputs = torch.hstack((embedded, self.visual_features(model_inputs)))
+            predictions = self.model.hidden_layers(all_inputs).view(-1)
+        predictions *= self.input_helper.maxes["Pret (EUR)"]
+
+        features = all_inputs if include_visual else embedded
+        return predictions.tolist(), features.numpy()
+
+    def visual_features(self, model_inputs: List[ModelInput]) -> torch.Tensor:
+        """Compute the visual features of the image of every input."""
+        assert all(x.image is not None for x in model_inputs), \
+            "you must provide an image"
+
+        # Inputs often share the same image (for example, during a sweep), so
+        # each distinct image is processed only once. Its visual features are
+        # then broadcast to every input which uses it.
+        positions: Dict[int, int] = {}
+        images = []
+        for x in model_inputs:
+            if id(x.image) not in positions:
+                positions[id(x.image)] = len(images)
+                images.append(self.image_transforms(x.image))
+        rows = torch.tensor([positions[id(x.image)] for x in model_inputs])
+
+        with torch.no_grad():
+            return self.model.conv(torch.stack(images))[rows]
 
-        prediction = self.model(inputs, indices, images).item()
-        prediction *= self.input_helper.maxes["Pret (EUR)"]
-        return prediction
+    def features(self, model_inputs: List[ModelInput], include_visual: bool = False) -> np.ndarray:
+        """Compute the feature vectors used to search for comparable listings."""
+        return self.predict_with_features(model_inputs, include_visual)[1]
@@ -0,0 +1,171 @@
+"""
+This module compares variants of the visual branch of `VisualModel`.
+
+Every variant is trained and evaluated on the same split of the data. The report
+lists their parameter count, FLOPs and CPU latency for a single prediction,
+and their mean absolute error in EUR, so that a faster model can be chosen
+knowing what it costs in accuracy.
+
+The error is measured after the last epoch. Picking the best epoch on the
+validation set would make the reported errors optimistic.
+
+It can be used as a stand-alone script, from the root of the repository:
+
+    python3 -m src.compare_visual --epochs 12 --variants baseline gap-128 gap-96
+"""
+
+import argparse
+import statistics
+import time
+from typing import Any, Dict, List
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from . import visual_training
+from .training import TARGET_COL
+
+# The configurations of the visual branch which can be compared.
+VARIANTS: Dict[str, Dict[str, Any]] = {
+    # The original model, which flattens the whole output of the convolutions.
+    "baseline": dict(image_size=128, channels=(16, 32), pool_size=None),
+    # Global average pooling, at the original resolution.
+    "gap-128": dict(image_size=128, channels=(16, 32), pool_size=1),
+    # Global average pooling, at a lower resolution, with a third block.
+    "gap-96": dict(image_size=96, channels=(16, 32, 64), pool_size=1),
+    # A coarse 2x2 pooling grid on small images, which keeps some layout.
+    "pool2-64": dict(image_size=64, channels=(16, 32), pool_size=2),
+    # A narrow network on small images.
+    "gap-64-narrow": dict(image_size=64, channels=(8, 16), pool_size=1),
+}
+
+
+def count_params(model: nn.Module) -> int:
+    """Count the trainable parameters of a model."""
+    return sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+
+@torch.no_grad()
+def count_flops(model: nn.Module, sample: tuple) -> int:
+    """
+    Count the floating point operations needed for a single prediction.
+
+    Only convolutional and linear layers are counted, since they dominate the
+    cost. A multiply-add counts as two operations.
+    """
+    flops = 0
+
+    def conv_hook(layer: nn.Conv2d, _, output: torch.Tensor):
+        nonlocal flops
+        kernel_ops = layer.in_channels // layer.groups * layer.kernel_size[0] * layer.kernel_size[1]
+        flops += 2 * output[0].numel() * kernel_ops
+
+    def linear_hook(layer: nn.Linear, _, output: torch.Tensor):
+        nonlocal flops
+        flops += 2 * layer.in_features * layer.out_features
+
+    hooks = []
+    for layer in model.modules():
+        if isinstance(layer, nn.Conv2d):
+            hooks.append(layer.register_forward_hook(conv_hook))
+        elif isinstance(layer, nn.Linear):
+            hooks.append(layer.register_forward_hook(linear_hook))
+
+    model.eval()
+    model(*sample)
+    for hook in hooks:
+        hook.remove()
+    return flops
+
+
+@torch.no_grad()
+def measure_latency(model: nn.Module, sample: tuple, repeats: int = 50) -> float:
+    """Measure the median CPU latency of a single prediction, in milliseconds."""
+    model.eval()
+    for _ in range(5):
+        model(*sample)
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model(*sample)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def compare(variants: List[str], epochs: int, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Train and evaluate the given variants, and return their metrics."""
+    # Variants with the same image size share their data. The split does not
+    # depend on the image size, so all variants see the same listings.
+    datasets: Dict[int, tuple] = {}
+    results = []
+
+    for name in variants:
+        config = VARIANTS[name]
+        image_size = config["image_size"]
+        if image_size not in datasets:
+            datasets[image_size] = visual_training.prepare_data(
+                args.data, args.image_dir, image_size, seed=args.seed)
+        dataset_train, dataset_valid, input_helper = datasets[image_size]
+        scale_coeff = input_helper.maxes[TARGET_COL]
+
+        torch.manual_seed(args.seed)
+        loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True)
+        loader_valid = DataLoader(dataset_valid, batch_size=args.batch_size)
+
+        model = visual_training.make_model(input_helper, **config)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate)
+
+        print(f"Training variant '{name}'...")
+        mae = visual_training.fit(
+            model, loader_train, loader_valid, optimizer, scale_coeff, epochs, keep_best=False)
+
+        sample = tuple(t[:1] for t in next(iter(loader_valid))[:3])
+        results.append({
+            "name": name,
+            "params": count_params(model),
+            "visual_params": count_params(model.conv),
+            "mflops": count_flops(model, sample) / 1e6,
+            "latency_ms": measure_latency(model, sample),
+            "mae": mae,
+        })
+    return results
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    """Print the metrics of the compared variants as a table."""
+    print()
+    print(f"{'Variant':<16}{'Params':>10}{'Visual':>10}{'MFLOPs':>10}{'Latency (ms)':>14}{'MAE (EUR)':>12}")
+    for r in results:
+        print(
+            f"{r['name']:<16}{r['params']:>10,}{r['visual_params']:>10,}"
+            f"{r['mflops']:>10.2f}{r['latency_ms']:>14.3f}{r['mae']:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    # Parse command line arguments.
+    parser = argparse.ArgumentParser(description="Comparison of visual model variants")
+    parser.add_argument(
+        "--data", help="The CSV file with listings", type=str,
+        default=visual_training.DF_PATH)
+    parser.add_argument(
+        "--image-dir", help="The directory of cropped images", type=str,
+        default=visual_training.IMAGE_DIR)
+    parser.add_argument(
+        "--variants", help="The variants to compare", nargs="+",
+        choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument(
+        "--epochs", help="The number of epochs", type=int, default=12)
+    parser.add_argument(
+        "--batch-size", help="The batch size", type=int,
+        default=visual_training.BATCH_SIZE)
+    parser.add_argument(
+        "--learning-rate", help="The learning rate", type=float,
+        default=visual_training.LEARNING_RATE)
+    parser.add_argument(
+        "--seed", help="The random seed", type=int, default=visual_training.TORCH_SEED)
+    args = parser.parse_args()
+
+    print_report(compare(args.variants, args.epochs, args))
@@ -0,0 +1,268 @@
+"""
+This module trains the visual model with data parallelism over CPU processes.
+
+Every process trains a replica of the model on its own shard of each batch, and
+gradients are averaged through `torch.distributed`, using the gloo backend.
+
+It can be used as a stand-alone script, from the root of the repository:
+
+    python3 -m src.distributed --processes 8 --epochs 12
+
+To measure how the epoch time scales with the number of processes, use:
+
+    python3 -m src.distributed --scaling-report 1,2,4,8 --epochs 2
+"""
+
+import argparse
+import os
+import socket
+import time
+from typing import List, Optional
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
+
+from . import utils, visual_training
+from .training import TARGET_COL
+
+
+class AllReduceSum(torch.autograd.Function):
+    """
+    Sum a tensor over all processes, in a differentiable way.
+
+    The gradient of the sum with respect to the tensor of each process is the
+    sum of the gradients of all processes. This replaces the deprecated
+    `torch.distributed.nn.functional.all_reduce`.
+    """
+
+    @staticmethod
+    def forward(ctx, input):
+        output = input.clone()
+        dist.all_reduce(output)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_input = grad_output.clone()
+        dist.all_reduce(grad_input)
+        return grad_input
+
+
+class SyncBatchNorm(nn.modules.batchnorm._BatchNorm):
+    """
+    Batch normalization which computes statistics over the batches of all
+    processes, instead of only the local shard.
+
+    `nn.SyncBatchNorm` only supports GPUs, so this layer is built from
+    differentiable collectives, which also work with gloo on CPUs. Its state is
+    the same as that of the layer it replaces, so checkpoints stay compatible.
+    """
+
+    def _check_input_dim(self, input):
+        if input.dim() < 2:
+            raise ValueError(f"expected at least 2D input (got {input.dim()}D input)")
+
+    def forward(self, input):
+        if not self.training or not dist.is_initialized() or dist.get_world_size() == 1:
+            return super().forward(input)
+
+        # Sum the counts, sums and sums of squares of every channel, over all
+        # processes, in a single collective.
+        channels = input.shape[1]
+        dims = [0] + list(range(2, input.dim()))
+        count = torch.full((1,), input.numel() // channels, dtype=input.dtype)
+        stats = torch.cat([input.sum(dims), (input * input).sum(dims), count])
+        stats = AllReduceSum.apply(stats)
+
+        total = stats[-1]
+        mean = stats[:channels] / total
+        var = (stats[channels:2*channels] / total - mean * mean).clamp(min=0)
+
+        if self.track_running_stats:
+            self.num_batches_tracked += 1
+            if self.momentum is None:
+                factor = 1.0 / float(self.num_batches_tracked)
+            else:
+                factor = self.momentum
+            with torch.no_grad():
+                unbiased_var = var * total / (total - 1)
+                self.running_mean.mul_(1 - factor).add_(mean * factor)
+                self.running_var.mul_(1 - factor).add_(unbiased_var * factor)
+
+        shape = [1, channels] + [1] * (input.dim() - 2)
+        out = (input - mean.view(shape)) / torch.sqrt(var.view(shape) + self.eps)
+        if self.affine:
+            out = out * self.weight.view(shape) + self.bias.view(shape)
+        return out
+
+    @staticmethod
+    def convert(module: nn.Module) -> nn.Module:
+        """Replace every batch norm layer inside a module, keeping its state."""
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            converted = SyncBatchNorm(
+                module.num_features, module.eps, module.momentum,
+                module.affine, module.track_running_stats,
+                dtype=module.running_mean.dtype,
+            )
+            converted.load_state_dict(module.state_dict())
+            return converted
+
+        for name, child in module.named_children():
+            module.add_module(name, SyncBatchNorm.convert(child))
+        return module
+
+
+def free_port() -> int:
+    """Find a free local port, used by the processes to find each other."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def worker(
+    rank: int,
+    world_size: int,
+    port: int,
+    datasets: tuple,
+    args: argparse.Namespace,
+    results: Optional[mp.SimpleQueue],
+) -> None:
+    """Train the model as one of `world_size` processes."""
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    # Split the cores between processes, to avoid oversubscribing them.
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(args.seed)
+
+    dataset_train, dataset_valid, input_helper = datasets
+    scale_coeff = input_helper.maxes[TARGET_COL]
+
+    # The batch size is global, so that training behaves the same way for
+    # any number of processes.
+    batch_size = max(1, args.batch_size // world_size)
+    sampler_train = DistributedSampler(
+        dataset_train, num_replicas=world_size, rank=rank, shuffle=True, seed=args.seed)
+    loader_train = DataLoader(dataset_train, batch_size=batch_size, sampler=sampler_train)
+
+    # Only the first process evaluates the model, on the whole validation set.
+    # Sharding it would pad the shards with duplicate samples, so the error and
+    # the saved model would depend on the number of processes.
+    loader_valid = DataLoader(dataset_valid, batch_size=args.batch_size)
+
+    model = SyncBatchNorm.convert(visual_training.make_model(input_helper))
+    ddp_model = DistributedDataParallel(model)
+    optimizer = torch.optim.AdamW(ddp_model.parameters(), lr=args.learning_rate)
+
+    epoch_times = []
+    best_loss = None
+    for epoch in range(args.epochs):
+        sampler_train.set_epoch(epoch)
+
+        start = time.perf_counter()
+        loss_train = visual_training.train_epoch(ddp_model, loader_train, optimizer, scale_coeff)
+        epoch_times.append(time.perf_counter() - start)
+
+        totals = torch.tensor([loss_train], dtype=torch.float64)
+        dist.all_reduce(totals)
+        loss_train = totals.item() / world_size
+
+        if rank == 0:
+            total, count = visual_training.evaluate(model, loader_valid, scale_coeff)
+            loss_valid = total / count
+            print(
+                f"Epoch {epoch}:\ttrain loss: {loss_train/len(loader_train):.5f}" +
+                f"\tmean valid difference: {loss_valid:.2f} EUR" +
+                f"\ttime: {epoch_times[-1]:.2f} s"
+            )
+
+            if args.save and (best_loss is None or loss_valid < best_loss):
+                best_loss = loss_valid
+                utils.store_model_weights(model, args.model_name, args.dir)
+
+    if rank == 0:
+        if args.save:
+            utils.store_model_helper(input_helper, f"{args.model_name}-helper.pkl", args.dir)
+        if results is not None:
+            results.put(epoch_times)
+
+    dist.destroy_process_group()
+
+
+def train(world_size: int, datasets: tuple, args: argparse.Namespace) -> List[float]:
+    """Train the model with the given number of processes."""
+    # The images are shared between processes, instead of being copied.
+    for dataset in datasets[:2]:
+        dataset.images.share_memory_()
+
+    results = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(
+        worker,
+        args=(world_size, free_port(), datasets, args, results),
+        nprocs=world_size,
+        join=True,
+    )
+    return results.get()
+
+
+def scaling_report(process_counts: List[int], datasets: tuple, args: argparse.Namespace) -> None:
+    """Compare the epoch time of training with different numbers of processes."""
+    mean_times = {}
+    for world_size in process_counts:
+        print(f"Training with {world_size} process(es)...")
+        epoch_times = train(world_size, datasets, args)
+        mean_times[world_size] = sum(epoch_times) / len(epoch_times)
+
+    baseline = mean_times[process_counts[0]] * process_counts[0]
+    print()
+    print("Processes  Epoch time (s)  Speedup  Efficiency")
+    for world_size, epoch_time in mean_times.items():
+        speedup = mean_times[process_counts[0]] / epoch_time
+        efficiency = baseline / (epoch_time * world_size)
+        print(f"{world_size:9}  {epoch_time:14.2f}  {speedup:7.2f}  {efficiency:10.0%}")
+
+
+if __name__ == "__main__":
+    # Parse command line arguments.
+    parser = argparse.ArgumentParser(description="Data-parallel CPU training of the visual model")
+    parser.add_argument(
+        "--data", help="The CSV file with listings", type=str,
+        default=visual_training.DF_PATH)
+    parser.add_argument(
+        "--image-dir", help="The directory of cropped images", type=str,
+        default=visual_training.IMAGE_DIR)
+    parser.add_argument(
+        "--dir", help="The directory where the model is saved", type=str, default="models")
+    parser.add_argument(
+        "--model-name", help="The name of the trained model", type=str, default="visualmodel")
+    parser.add_argument(
+        "--processes", help="The number of processes", type=int,
+        default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--epochs", help="The number of epochs", type=int, default=12)
+    parser.add_argument(
+        "--batch-size", help="The global batch size", type=int,
+        default=visual_training.BATCH_SIZE)
+    parser.add_argument(
+        "--learning-rate", help="The learning rate", type=float,
+        default=visual_training.LEARNING_RATE)
+    parser.add_argument(
+        "--seed", help="The random seed", type=int, default=visual_training.TORCH_SEED)
+    parser.add_argument(
+        "--scaling-report", help="Only report epoch times for these process counts (e.g. 1,2,4,8)",
+        type=str, default=None)
+    args = parser.parse_args()
+
+    datasets = visual_training.prepare_data(args.data, args.image_dir, seed=args.seed)
+
+    if args.scaling_report:
+        args.save = False
+        scaling_report([int(n) for n in args.scaling_report.split(",")], datasets, args)
+    else:
+        args.save = True
+        train(args.processes, datasets, args)
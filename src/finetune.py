@@ -0,0 +1,253 @@
+"""
+This module fine-tunes an existing simple or visual model on newly scraped
+listings.
+
+Instead of training from scratch, it loads a model from disk, extends its
+vocabularies and embedding tables with the brands/models/etc. seen in the new
+listings, and trains it for a few epochs on the new listings mixed with a
+sample of the old ones (replayed, so that the model does not forget them).
+
+It can be used as a stand-alone script, from the root of the repository:
+
+    python3 -m src.finetune --new data/new_listings.csv --model-name firstmodel \\
+        --output-name firstmodel-refreshed
+
+Visual models are detected automatically. Only listings with an image are used
+to fine-tune them:
+
+    python3 -m src.finetune --new data/new_listings.csv --model-name visualmodel \\
+        --output-name visualmodel-refreshed --image-dir data/small_images
+"""
+
+import argparse
+import os
+import re
+from typing import Any, Dict, Optional
+
+import pandas as pd
+import torch
+import torch.nn as nn
+from sklearn.model_selection import train_test_split
+
+from . import simplemodel, training, utils, visual_training, visualmodel
+from .training import COLS_NORMAL, COLS_TO_EMBED, COLS_TO_SCALE, TARGET_COL
+
+
+def model_from_state_dict(state_dict: Dict[str, Any], **visual_config) -> nn.Module:
+    """
+    Build a model whose architecture matches the given state dict.
+
+    State dicts with a convolutional backbone give a `VisualModel`. The channels
+    of its blocks are read from the state dict, but the image size and pooling
+    leave no trace in it, so they are taken from `visual_config`.
+    """
+    embedding_shapes = [
+        state_dict[f"embeddings.{i}.weight"].shape
+        for i in range(len(COLS_TO_EMBED))
+    ]
+
+    # The hidden layers contain linear layers, each followed by batch norm and
+    # ReLU, except for the last one. Only linear layers have 2D weights.
+    linear_indices = sorted(
+        int(match.group(1))
+        for key, value in state_dict.items()
+        if (match := re.fullmatch(r"hidden_layers\.(\d+)\.weight", key)) and value.dim() == 2
+    )
+    linear_shapes = [state_dict[f"hidden_layers.{i}.weight"].shape for i in linear_indices]
+
+    embedding_dim = embedding_shapes[0][1]
+    input_size = linear_shapes[0][1] - len(COLS_TO_EMBED) * embedding_dim
+    model_args = dict(
+        vocab_lens=[shape[0] for shape in embedding_shapes],
+        embedding_dim=embedding_dim,
+        hidden_sizes=[shape[0] for shape in linear_shapes[:-1]],
+    )
+
+    if not any(key.startswith("conv.") for key in state_dict):
+        model = simplemodel.SimpleModel(input_size=input_size, **model_args)
+        model.load_state_dict(state_dict)
+        return model
+
+    # Each convolutional block starts with a convolution, the only layer with
+    # 4D weights. The visual features come out of the only linear layer of the
+    # backbone, which has 2D weights.
+    block_indices = sorted(
+        int(match.group(1))
+        for key, value in state_dict.items()
+        if (match := re.fullmatch(r"conv\.(\d+)\.0\.weight", key)) and value.dim() == 4
+    )
+    visual_features = next(
+        value.shape[0]
+        for key, value in state_dict.items()
+        if re.fullmatch(r"conv\.\d+\.weight", key) and value.dim() == 2
+    )
+
+    model = visualmodel.VisualModel(
+        input_size=input_size - visual_features,
+        channels=tuple(state_dict[f"conv.{i}.0.weight"].shape[0] for i in block_indices),
+        **model_args,
+        **visual_config,
+    )
+    model.load_state_dict(state_dict)
+    return model
+
+
+def make_loader(
+    df: pd.DataFrame,
+    helper: simplemodel.InputHelper,
+    batch_size: int,
+    shuffle: bool,
+    image_dir: Optional[str] = None,
+    image_size: int = visual_training.IMAGE_SIZE,
+):
+    """Build a dataloader over the given listings, with their images if `image_dir` is given."""
+    if image_dir is not None:
+        images = visual_training.load_images(df, image_dir, image_size)
+        dataset = visual_training.DatasetWithImages(df, images, helper)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+
+    inputs, indices = simplemodel.make_inputs(
+        helper,
+        cols_to_scale=df[COLS_TO_SCALE],
+        cols_normal=df[COLS_NORMAL],
+        cols_to_embed=df[COLS_TO_EMBED],
+    )
+    prices = torch.tensor(df[TARGET_COL].values)
+    prices /= helper.maxes[TARGET_COL]
+
+    dataset = torch.utils.data.TensorDataset(inputs, indices, prices)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+
+
+def finetune(
+    model: nn.Module,
+    helper: simplemodel.InputHelper,
+    df_new: pd.DataFrame,
+    df_old: pd.DataFrame,
+    replay_size: int,
+    epochs: int,
+    batch_size: int = 128,
+    learning_rate: float = 1e-3,
+    seed: int = 13,
+    image_dir: Optional[str] = None,
+    image_size: int = visual_training.IMAGE_SIZE,
+) -> simplemodel.InputHelper:
+    """
+    Fine-tune a model in place on new listings and replayed old listings.
+
+    Visual models also need the directory of the images, and the image size
+    they were trained with. Listings without an image are skipped for them.
+
+    Returns the extended helper which must be used with the fine-tuned model.
+    """
+    visual = isinstance(model, visualmodel.VisualModel)
+    assert not visual or image_dir is not None, "visual models need images"
+    torch.manual_seed(seed)
+
+    if visual:
+        df_new = visual_training.with_images(df_new, image_dir)
+        df_old = visual_training.with_images(df_old, image_dir)
+    else:
+        image_dir = None
+
+    # Extend the vocabularies and scaling constants, and adapt the model to
+    # them, so that its predictions are unchanged before fine-tuning starts.
+    new_helper = simplemodel.extend_input_helper(
+        helper, df_new[COLS_TO_SCALE + [TARGET_COL]], df_new[COLS_TO_EMBED])
+    training.grow_embeddings(
+        model.embeddings, [len(new_helper.vocabs[col]) for col in COLS_TO_EMBED])
+    training.rescale_model(
+        model, helper.maxes, new_helper.maxes, COLS_TO_SCALE, TARGET_COL)
+
+    for col in COLS_TO_EMBED:
+        added = len(new_helper.vocabs[col]) - len(helper.vocabs[col])
+        if added:
+            print(f"Added {added} new values for '{col}'")
+
+    # Listings which were scraped again are only used as new listings.
+    df_old = df_old[~df_old["Autovit Id"].isin(df_new["Autovit Id"])]
+    replay = df_old.sample(n=min(replay_size, len(df_old)), random_state=seed)
+    df = pd.concat([df_new, replay])
+    df_train, df_valid = train_test_split(df, train_size=0.8, random_state=seed)
+    print(f"Fine-tuning on {len(df_new)} new and {len(replay)} replayed listings")
+
+    loader_train = make_loader(df_train, new_helper, batch_size, True, image_dir, image_size)
+    loader_valid = make_loader(df_valid, new_helper, batch_size, False, image_dir, image_size)
+
+    # Each model keeps the loss it was trained with: MSE for simple models and
+    # `price_loss` for visual ones. States are compared by their mean absolute
+    # error, like for the other models.
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    visual_training.fit(
+        model, loader_train, loader_valid, optimizer, new_helper.maxes[TARGET_COL], epochs,
+        loss_function=None if visual else nn.MSELoss(),
+    )
+
+    return new_helper
+
+
+if __name__ == "__main__":
+    # Parse command line arguments.
+    parser = argparse.ArgumentParser(description="Incremental fine-tuning of a simple or visual model")
+    parser.add_argument(
+        "--new", help="The CSV file with new listings", type=str, required=True)
+    parser.add_argument(
+        "--old", help="The CSV file with the listings used so far", type=str,
+        default=os.path.join("data", "carsWithImageCleaned.csv"))
+    parser.add_argument(
+        "--dir", help="The directory of the models", type=str, default="models")
+    parser.add_argument(
+        "--model-name", help="The name of the model to fine-tune", type=str, required=True)
+    parser.add_argument(
+        "--helper", help="The filename of the model helper (default: <model-name>-helper.pkl)",
+        type=str, default=None)
+    parser.add_argument(
+        "--output-name", help="The name of the fine-tuned model", type=str, required=True)
+    parser.add_argument(
+        "--keep-outliers", help="Keep price outliers, for models which were trained with them",
+        action="store_true")
+    parser.add_argument(
+        "--image-dir", help="The directory of cropped images (visual models only)", type=str,
+        default=visual_training.IMAGE_DIR)
+    parser.add_argument(
+        "--image-size", help="The image size of the model (visual models only)", type=int,
+        default=visual_training.IMAGE_SIZE)
+    parser.add_argument(
+        "--pool-size", help="The pooling grid of the model (visual models only)", type=int,
+        default=None)
+    parser.add_argument(
+        "--replay-size", help="The number of old listings to replay", type=int, default=2000)
+    parser.add_argument(
+        "--epochs", help="The number of epochs", type=int, default=5)
+    parser.add_argument(
+        "--learning-rate", help="The learning rate", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    helper = utils.load_model_helper(args.helper or f"{args.model_name}-helper.pkl", args.dir)
+    model = model_from_state_dict(
+        utils.load_state_dict(args.model_name, args.dir),
+        image_size=args.image_size,
+        pool_size=args.pool_size,
+    )
+
+    df_new = pd.read_csv(args.new, index_col=0)
+    df_old = pd.read_csv(args.old, index_col=0)
+    if not args.keep_outliers:
+        # Skip price outliers, like the training notebooks do. The bounds come
+        # from the old listings, which the model was trained on, so that the new
+        # listings are filtered the same way.
+        old_prices = df_old[TARGET_COL]
+        df_new = df_new[utils.inlier_mask(df_new[TARGET_COL], reference=old_prices)]
+        df_old = df_old[utils.inlier_mask(old_prices)]
+
+    new_helper = finetune(
+        model, helper, df_new, df_old,
+        replay_size=args.replay_size,
+        epochs=args.epochs,
+        learning_rate=args.learning_rate,
+        image_dir=args.image_dir,
+        image_size=args.image_size,
+    )
+
+    utils.store_model_weights(model, args.output_name, args.dir)
+    utils.store_model_helper(new_helper, f"{args.output_name}-helper.pkl", args.dir)
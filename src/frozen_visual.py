@@ -0,0 +1,215 @@
+"""
+This module trains the visual model with a frozen convolutional backbone.
+
+The backbone (`VisualModel.conv`) is taken from a trained model and is not
+updated, so its output for an image never changes. The visual features of every
+listing are computed once and cached on disk, keyed by Autovit Id and by a hash
+of the backbone. The embeddings and hidden layers are then trained from the
+cached features, as fast as a tabular model.
+
+It can be used as a stand-alone script, from the root of the repository:
+
+    python3 -m src.frozen_visual --backbone visualmodel --hidden-sizes 64 32 \\
+        --model-name visualmodel-frozen
+"""
+
+import argparse
+import hashlib
+import os
+from typing import Any, Dict
+
+import pandas as pd
+import torch
+import torch.nn as nn
+from sklearn.model_selection import train_test_split
+from torch.utils.data import DataLoader, TensorDataset
+
+from . import simplemodel, utils, visual_training
+from .training import COLS_NORMAL, COLS_TO_EMBED, COLS_TO_SCALE, TARGET_COL
+
+# The default directory of cached visual features.
+DEFAULT_CACHE_DIR = os.path.join("data", "visual_features")
+
+
+def backbone_hash(conv: nn.Module, visual_config: Dict[str, Any]) -> str:
+    """Compute a hash which identifies the configuration and weights of a backbone."""
+    digest = hashlib.sha256(repr(sorted(visual_config.items())).encode())
+    for name, tensor in sorted(conv.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.cpu().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def freeze_backbone(model: nn.Module) -> None:
+    """
+    Stop training the convolutional part of a visual model.
+
+    Only its parameters are frozen. The backbone is not called while training
+    from cached features, and the features are computed in evaluation mode.
+    """
+    for param in model.conv.parameters():
+        param.requires_grad = False
+
+
+@torch.no_grad()
+def cached_features(
+    conv: nn.Module,
+    df: pd.DataFrame,
+    image_dir: str,
+    visual_config: Dict[str, Any],
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    batch_size: int = 256,
+) -> torch.Tensor:
+    """
+    Get the visual features of every listing, in the order of `df`.
+
+    The backbone must have been built with `visual_config`, which also gives
+    the size of the images. Features are read from the cache of the backbone if
+    possible. Only the listings missing from it are processed, and then added
+    to it.
+    """
+    path = os.path.join(cache_dir, f"features-{backbone_hash(conv, visual_config)}.pt")
+    cache = torch.load(path) if os.path.isfile(path) else {}
+
+    missing = df[~df["Autovit Id"].isin(list(cache))]
+    if len(missing):
+        print(f"Computing the visual features of {len(missing)} listings")
+        conv.eval()
+        for start in range(0, len(missing), batch_size):
+            chunk = missing.iloc[start:start+batch_size]
+            images = visual_training.load_images(chunk, image_dir, visual_config["image_size"])
+            for id, features in zip(chunk["Autovit Id"], conv(images.float() / 255)):
+                cache[int(id)] = features.clone()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(cache, path)
+        print(f"Saved the cached features to '{path}'")
+
+    return torch.stack([cache[int(id)] for id in df["Autovit Id"]])
+
+
+def make_loader(
+    df: pd.DataFrame,
+    features: torch.Tensor,
+    input_helper: simplemodel.InputHelper,
+    batch_size: int,
+    shuffle: bool,
+) -> DataLoader:
+    """Build a dataloader over listings and their cached visual features."""
+    inputs, indices = simplemodel.make_inputs(
+        input_helper,
+        df[COLS_TO_SCALE],
+        df[COLS_NORMAL],
+        df[COLS_TO_EMBED],
+    )
+    prices = torch.tensor(df[TARGET_COL].values) / input_helper.maxes[TARGET_COL]
+    dataset = TensorDataset(inputs, indices, features, prices)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+
+
+def train_frozen(
+    model: nn.Module,
+    loader_train: DataLoader,
+    loader_valid: DataLoader,
+    scale_coeff: float,
+    epochs: int,
+    learning_rate: float,
+) -> None:
+    """Train the non-visual part of a model from cached visual features."""
+    optimizer = torch.optim.AdamW(
+        [p for p in model.parameters() if p.requires_grad], lr=learning_rate)
+    visual_training.fit(
+        model, loader_train, loader_valid, optimizer, scale_coeff, epochs, forward=model.combine)
+
+
+if __name__ == "__main__":
+    # Parse command line arguments.
+    parser = argparse.ArgumentParser(description="Training of the visual model with a frozen backbone")
+    parser.add_argument(
+        "--data", help="The CSV file with listings", type=str,
+        default=visual_training.DF_PATH)
+    parser.add_argument(
+        "--image-dir", help="The directory of cropped images", type=str,
+        default=visual_training.IMAGE_DIR)
+    parser.add_argument(
+        "--cache-dir", help="The directory of cached visual features", type=str,
+        default=DEFAULT_CACHE_DIR)
+    parser.add_argument(
+        "--dir", help="The directory of the models", type=str, default="models")
+    parser.add_argument(
+        "--backbone", help="The name of the model which provides the backbone", type=str,
+        default="visualmodel")
+    parser.add_argument(
+        "--model-name", help="The name of the trained model", type=str, required=True)
+    parser.add_argument(
+        "--image-size", help="The size of the images taken by the backbone", type=int,
+        default=visual_training.IMAGE_SIZE)
+    parser.add_argument(
+        "--channels", help="The channels of the convolutional blocks of the backbone",
+        type=int, nargs="+", default=[16, 32])
+    parser.add_argument(
+        "--pool-size", help="The pooling grid of the backbone (default: no pooling)",
+        type=int, default=None)
+    parser.add_argument(
+        "--embedding-dim", help="The size of the embeddings", type=int,
+        default=visual_training.EMBEDDING_DIM)
+    parser.add_argument(
+        "--hidden-sizes", help="The sizes of the hidden layers", type=int, nargs="+",
+        default=visual_training.HIDDEN_SIZES)
+    parser.add_argument(
+        "--epochs", help="The number of epochs", type=int, default=50)
+    parser.add_argument(
+        "--batch-size", help="The batch size", type=int,
+        default=visual_training.BATCH_SIZE)
+    parser.add_argument(
+        "--learning-rate", help="The learning rate", type=float,
+        default=visual_training.LEARNING_RATE)
+    parser.add_argument(
+        "--seed", help="The random seed", type=int, default=visual_training.TORCH_SEED)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+
+    # Use the same split as the other training scripts.
+    df = visual_training.load_listings(args.data, args.image_dir)
+    df_train, df_valid = train_test_split(
+        df, train_size=visual_training.TRAIN_SIZE, random_state=args.seed)
+    input_helper = simplemodel.make_input_helper(
+        df_train[COLS_TO_SCALE + [TARGET_COL]],
+        df_train[COLS_TO_EMBED],
+    )
+
+    # Build the new model around the trained backbone, which must have been
+    # trained with the same visual configuration.
+    visual_config = dict(
+        image_size=args.image_size,
+        channels=tuple(args.channels),
+        pool_size=args.pool_size,
+    )
+    model = visual_training.make_model(
+        input_helper, args.embedding_dim, args.hidden_sizes, **visual_config)
+    backbone_state = utils.load_state_dict(args.backbone, args.dir)
+    model.conv.load_state_dict({
+        key[len("conv."):]: value
+        for key, value in backbone_state.items()
+        if key.startswith("conv.")
+    })
+    freeze_backbone(model)
+
+    # The features of both sets are fetched together, so that the cache is read
+    # and written only once.
+    features = cached_features(
+        model.conv, pd.concat([df_train, df_valid]), args.image_dir, visual_config, args.cache_dir)
+    features_train, features_valid = features[:len(df_train)], features[len(df_train):]
+
+    train_frozen(
+        model,
+        make_loader(df_train, features_train, input_helper, args.batch_size, shuffle=True),
+        make_loader(df_valid, features_valid, input_helper, args.batch_size, shuffle=False),
+        input_helper.maxes[TARGET_COL],
+        args.epochs,
+        args.learning_rate,
+    )
+
+    utils.store_model_weights(model, args.model_name, args.dir)
+    utils.store_model_helper(input_helper, f"{args.model_name}-helper.pkl", args.dir)
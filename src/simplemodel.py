@@ -5,16 +5,20 @@ and preparing input for it.
 The model implemented here contains a sequence of linear layers.
 """
 
+import copy
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 
 from .training import Vocabulary
 
+# `pandas` is only needed when preparing data for training, so it is not
+# imported when serving predictions.
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 @dataclass
 class InputHelper:
@@ -25,7 +29,7 @@ class InputHelper:
     vocabs: Dict[str, Vocabulary]
 
 
-def make_input_helper(cols_to_scale: pd.DataFrame, cols_to_embed: pd.DataFrame) -> InputHelper:
+def make_input_helper(cols_to_scale: "pd.DataFrame", cols_to_embed: "pd.DataFrame") -> InputHelper:
     """
     Remember useful information about the given data, such as scaling constants.
     """
@@ -41,13 +45,35 @@ def make_input_helper(cols_to_scale: pd.DataFrame, cols_to_embed: pd.DataFrame)
     )
 
 
+def extend_input_helper(
+    helper: InputHelper,
+    cols_to_scale: "pd.DataFrame",
+    cols_to_embed: "pd.DataFrame",
+) -> InputHelper:
+    """
+    Build a copy of a helper which also covers new data.
+
+    Vocabularies are extended with unseen words. Scaling constants only ever
+    grow, so that the data seen before keeps its range.
+    """
+    new_helper = copy.deepcopy(helper)
+    for col in cols_to_scale.columns:
+        new_helper.maxes[col] = max(helper.maxes[col], cols_to_scale[col].max())
+    for col in cols_to_embed.columns:
+        new_helper.vocabs[col].extend(cols_to_embed[col].tolist())
+    return new_helper
+
+
 def make_inputs(
     helper: InputHelper,
-    cols_to_scale: Optional[pd.DataFrame] = None,
-    cols_normal: Optional[pd.DataFrame] = None,
-    cols_to_embed: Optional[pd.DataFrame] = None,
+    cols_to_scale: Optional["pd.DataFrame"] = None,
+    cols_normal: Optional["pd.DataFrame"] = None,
+    cols_to_embed: Optional["pd.DataFrame"] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """Convert the given data into tensors which can be used as model inputs."""
+    import numpy as np
+    import pandas as pd
+
     inputs = None
     if cols_to_scale is not None:
         assert type(cols_to_scale) == pd.DataFrame, "should be a DataFrame"
@@ -71,6 +97,31 @@ def make_inputs(
     return inputs, indices
 
 
+def make_inputs_from_lists(
+    helper: InputHelper,
+    cols_to_scale: Dict[str, List[float]],
+    cols_normal: Dict[str, List[bool]],
+    cols_to_embed: Dict[str, List[str]],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Convert the given columns into model inputs, just like `make_inputs`.
+
+    Each argument maps column names to lists of values. This function does not
+    need `pandas`, so it is used on the inference-only path.
+    """
+    maxes = torch.tensor([float(helper.maxes[col]) for col in cols_to_scale], dtype=torch.float64)
+    scaled = torch.tensor(list(cols_to_scale.values()), dtype=torch.float64).T / maxes
+    rest = torch.tensor(list(cols_normal.values()), dtype=torch.float64).T
+    inputs = torch.hstack([scaled, rest])
+
+    indices = torch.tensor([
+        helper.vocabs[col].encode(values)
+        for col, values in cols_to_embed.items()
+    ]).T
+
+    return inputs, indices
+
+
 class SimpleModel(nn.Module):
     """
     A simple model for predicting car prices.
@@ -104,11 +155,18 @@ class SimpleModel(nn.Module):
         self.hidden_layers = nn.Sequential(*hidden)
 
     def forward(self, inputs, indices):
-        # Convert the indices into embeddings and add them to the other inputs.
+        all_inputs = self.embed(inputs, indices)
+        out = self.hidden_layers(all_inputs)
+        return out
+
+    def embed(self, inputs, indices):
+        """
+        Convert the indices into embeddings and add them to the other inputs.
+
+        The result is the feature vector processed by the hidden layers.
+        """
         all_inputs = inputs
         for i, emb_layer in enumerate(self.embeddings):
             col_indices = emb_layer(indices[:, i])
             all_inputs = torch.hstack((all_inputs, col_indices))
-
-        out = self.hidden_layers(all_inputs)
-        return out
+        return all_inputs
@@ -2,7 +2,25 @@
 This module contains code for training models.
 """
 
-from typing import List
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+
+# These are parameters of the data, shared with the training notebooks.
+COLS_TO_SCALE = [
+    "Anul", "Km", "Putere (CP)", "Capacitate cilindrica (cm3)",
+    "Numar de portiere", "Consum (l/100km)",
+]
+COLS_NORMAL = [
+    "Fara accident in istoric", "Carte de service",
+    "Filtru de particule", "Inmatriculat", "Primul proprietar",
+]
+COLS_TO_EMBED = [
+    "Marca", "Model", "Combustibil", "Cutie de viteze",
+    "Tip Caroserie", "Culoare", "Tractiune",
+]
+TARGET_COL = "Pret (EUR)"
 
 
 class Vocabulary:
@@ -19,6 +37,22 @@ class Vocabulary:
         self.word_to_index = {word: i+1 for i, word in enumerate(unique)}
         self.index_to_word = {i+1: word for i, word in enumerate(unique)}
 
+    def extend(self, words: List[str]) -> int:
+        """
+        Add new words to the vocabulary, keeping the indices of known words.
+
+        New words receive indices after all existing ones. Returns the number
+        of words which were added.
+        """
+        added = 0
+        for word in words:
+            if word not in self.word_to_index:
+                index = len(self)
+                self.word_to_index[word] = index
+                self.index_to_word[index] = word
+                added += 1
+        return added
+
     def __len__(self):
         return len(self.word_to_index) + 1
 
@@ -37,3 +71,54 @@ class Vocabulary:
     def decode(self, indices: List[int]) -> List[str]:
         """Decode a sequence of indices back into words."""
         return [self.get_word(index) for index in indices]
+
+
+def grow_embeddings(embeddings: nn.ModuleList, vocab_lens: List[int]) -> None:
+    """
+    Resize embedding tables in place, so that they fit extended vocabularies.
+
+    The rows of known words are kept. The rows of new words start as copies of
+    the row of the unknown word, so predictions for them do not change until
+    they are trained.
+    """
+    for i, (old, vocab_len) in enumerate(zip(embeddings, vocab_lens)):
+        assert vocab_len >= old.num_embeddings, "vocabularies can only grow"
+        if vocab_len == old.num_embeddings:
+            continue
+
+        grown = nn.Embedding(
+            vocab_len, old.embedding_dim, max_norm=old.max_norm,
+            device=old.weight.device, dtype=old.weight.dtype,
+        )
+        with torch.no_grad():
+            grown.weight[:old.num_embeddings] = old.weight
+            grown.weight[old.num_embeddings:] = old.weight[Vocabulary.UNKNOWN_INDEX]
+        embeddings[i] = grown
+
+
+def rescale_model(
+    model: nn.Module,
+    old_maxes: Dict[str, float],
+    new_maxes: Dict[str, float],
+    cols_to_scale: List[str],
+    target_col: str,
+) -> None:
+    """
+    Adapt a model in place to new scaling constants, without changing its
+    predictions.
+
+    Scaled inputs are divided by their maxes, so the weights which read them in
+    the first linear layer are multiplied by `new / old`. The target is scaled
+    the same way, so the last linear layer is multiplied by `old / new`.
+
+    The model must have `hidden_layers` which start and end with linear layers,
+    and the scaled inputs must come first, like `make_inputs` produces them.
+    """
+    first, last = model.hidden_layers[0], model.hidden_layers[-1]
+    with torch.no_grad():
+        for j, col in enumerate(cols_to_scale):
+            first.weight[:, j] *= new_maxes[col] / old_maxes[col]
+
+        ratio = old_maxes[target_col] / new_maxes[target_col]
+        last.weight *= ratio
+        last.bias *= ratio
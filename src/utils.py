@@ -4,19 +4,31 @@ This module contains utility functions used throughout the project.
 
 import os
 import pickle
-from typing import Any
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
-import pandas as pd
 import torch
 import torch.nn as nn
 
+if TYPE_CHECKING:  # Only used for type hints.
+    import pandas as pd
+
 # The default directory for saving models and other helpers.
 DEFAULT_MODEL_DIR = os.path.join("..", "models")
 
 
-def inlier_mask(series: pd.Series, iqr_window: float = 1.5) -> pd.Series:
-    """Compute a boolean mask that identifies inliers in a series."""
-    q1, q3 = series.quantile(0.25), series.quantile(0.75)
+def inlier_mask(
+    series: "pd.Series",
+    iqr_window: float = 1.5,
+    reference: Optional["pd.Series"] = None,
+) -> "pd.Series":
+    """
+    Compute a boolean mask that identifies inliers in a series.
+
+    By default, the bounds are computed from the series itself. They can also
+    be computed from a `reference` series, such as the data used for training.
+    """
+    reference = series if reference is None else reference
+    q1, q3 = reference.quantile(0.25), reference.quantile(0.75)
     iqr = q3 - q1
     return (q1 - iqr*iqr_window <= series) & (series <= q3 + iqr*iqr_window)
 
@@ -30,10 +42,19 @@ def store_model_weights(model: nn.Module, name: str, dir: str = DEFAULT_MODEL_DI
     print(f"Saved model state dict to '{filepath}'")
 
 
+def load_state_dict(name: str, dir: str = DEFAULT_MODEL_DIR) -> Dict[str, Any]:
+    """
+    Load the state dict of a model from disk, without applying it.
+
+    Tensors are loaded on the CPU, even if the model was trained on a GPU.
+    """
+    filepath = os.path.join(dir, f"{name}-statedict.pt")
+    return torch.load(filepath, map_location="cpu")
+
+
 def load_model_weights(model: nn.Module, name: str, dir: str = DEFAULT_MODEL_DIR) -> None:
     """Load the state dict of a model from disk."""
-    filepath = os.path.join(dir, f"{name}-statedict.pt")
-    model.load_state_dict(torch.load(filepath))
+    model.load_state_dict(load_state_dict(name, dir))
 
 
 def store_model_helper(object: Any, filename: str, dir: str = DEFAULT_MODEL_DIR) -> None:
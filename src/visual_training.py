@@ -0,0 +1,238 @@
+"""
+This module contains code for training the visual model outside of notebooks.
+
+It follows `notebooks/3-ap-train-visual.ipynb`: the same data, split, loss and
+hyperparameters are used by default.
+"""
+
+import copy
+import os
+from typing import Callable, List, Optional, Tuple
+
+import pandas as pd
+import torch
+import torchvision
+from PIL import Image
+from sklearn.model_selection import train_test_split
+from torch.utils.data import DataLoader, Dataset
+
+from . import simplemodel, utils, visualmodel
+from .training import COLS_NORMAL, COLS_TO_EMBED, COLS_TO_SCALE, TARGET_COL
+
+# These are the parameters used in the training notebook.
+DF_PATH = os.path.join("data", "carsWithImageCleaned.csv")
+IMAGE_DIR = os.path.join("data", "small_images")
+IMAGE_SIZE = 128
+EMBEDDING_DIM = 4
+HIDDEN_SIZES = [113, 25]
+BATCH_SIZE = 128
+LEARNING_RATE = 0.01
+TRAIN_SIZE = 0.66
+TORCH_SEED = 13
+
+
+def image_path(image_dir: str, autovit_id: int) -> str:
+    """Get the path of the image of a listing."""
+    id = str(autovit_id)
+    return os.path.join(image_dir, id, f"{id}.webp")
+
+
+def with_images(df: pd.DataFrame, image_dir: str) -> pd.DataFrame:
+    """Keep only the listings which have an image."""
+    has_image = [os.path.isfile(image_path(image_dir, id)) for id in df["Autovit Id"]]
+    return df[has_image]
+
+
+def load_listings(df_path: str, image_dir: str) -> pd.DataFrame:
+    """Load the listings which have an image, without price outliers."""
+    df = pd.read_csv(df_path, index_col=0)
+    df = df.drop(df[~utils.inlier_mask(df[TARGET_COL])].index)
+    return with_images(df, image_dir)
+
+
+def load_images(df: pd.DataFrame, image_dir: str, image_size: int) -> torch.Tensor:
+    """
+    Load the image of every listing, resized and cropped to the given size.
+
+    Images are kept as bytes, which take four times less memory than floats.
+    This also allows sharing them cheaply between processes.
+    """
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(image_size),
+        torchvision.transforms.CenterCrop(image_size),
+        torchvision.transforms.PILToTensor(),
+    ])
+    return torch.stack([
+        transforms(Image.open(image_path(image_dir, id)))
+        for id in df["Autovit Id"]
+    ])
+
+
+class DatasetWithImages(Dataset):
+    """A dataset which combines all inputs taken by the model."""
+
+    def __init__(self, df: pd.DataFrame, images: torch.Tensor, input_helper: simplemodel.InputHelper):
+        # The tabular inputs are converted once, for the whole dataset.
+        self.inputs, self.indices = simplemodel.make_inputs(
+            input_helper,
+            df[COLS_TO_SCALE],
+            df[COLS_NORMAL],
+            df[COLS_TO_EMBED],
+        )
+        self.prices = torch.tensor(df[TARGET_COL].values) / input_helper.maxes[TARGET_COL]
+        self.images = images
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getitem__(self, idx):
+        # This matches the conversion done by `torchvision.transforms.ToTensor`.
+        image = self.images[idx].float() / 255
+        return self.inputs[idx], self.indices[idx], image, self.prices[idx]
+
+
+def prepare_data(
+    df_path: str = DF_PATH,
+    image_dir: str = IMAGE_DIR,
+    image_size: int = IMAGE_SIZE,
+    train_size: float = TRAIN_SIZE,
+    seed: int = TORCH_SEED,
+) -> Tuple[DatasetWithImages, DatasetWithImages, simplemodel.InputHelper]:
+    """Build the training and validation datasets, and the input helper."""
+    df = load_listings(df_path, image_dir)
+    df_train, df_valid = train_test_split(df, train_size=train_size, random_state=seed)
+    print(f"Training set shape:   {df_train.shape}")
+    print(f"Validation set shape: {df_valid.shape}")
+
+    input_helper = simplemodel.make_input_helper(
+        df_train[COLS_TO_SCALE + [TARGET_COL]],
+        df_train[COLS_TO_EMBED],
+    )
+
+    dataset_train = DatasetWithImages(
+        df_train, load_images(df_train, image_dir, image_size), input_helper)
+    dataset_valid = DatasetWithImages(
+        df_valid, load_images(df_valid, image_dir, image_size), input_helper)
+    return dataset_train, dataset_valid, input_helper
+
+
+def make_model(
+    input_helper: simplemodel.InputHelper,
+    embedding_dim: int = EMBEDDING_DIM,
+    hidden_sizes: List[int] = HIDDEN_SIZES,
+    **visual_config,
+) -> visualmodel.VisualModel:
+    """
+    Build an untrained visual model which fits the given helper.
+
+    The visual branch can be configured with the keyword arguments accepted by
+    `VisualModel` (`image_size`, `channels` and `pool_size`).
+    """
+    return visualmodel.VisualModel(
+        input_size=len(COLS_TO_SCALE) + len(COLS_NORMAL),
+        vocab_lens=[len(input_helper.vocabs[col]) for col in COLS_TO_EMBED],
+        embedding_dim=embedding_dim,
+        hidden_sizes=hidden_sizes,
+        **visual_config,
+    )
+
+
+def price_loss(pred: torch.Tensor, real: torch.Tensor, scale_coeff: float) -> torch.Tensor:
+    """
+    Compute the mean absolute (real) difference between predicted and real
+    prices.
+    """
+    diffs = pred * scale_coeff - real * scale_coeff
+    return diffs.abs().mean()
+
+
+def train_epoch(
+    model: torch.nn.Module,
+    loader: DataLoader,
+    optimizer: torch.optim.Optimizer,
+    scale_coeff: float,
+    forward: Optional[Callable[..., torch.Tensor]] = None,
+    loss_function: Optional[Callable[[torch.Tensor, torch.Tensor], torch.Tensor]] = None,
+) -> float:
+    """
+    Train a model for one epoch, and return the sum of batch losses.
+
+    The last element of every batch is the target, and the others are passed to
+    `forward`, which calls the model by default. The loss defaults to
+    `price_loss`.
+    """
+    forward = forward or model
+    loss_function = loss_function or (lambda pred, real: price_loss(pred, real, scale_coeff))
+
+    loss_train = 0
+    model.train()
+    for *x, y in loader:
+        optimizer.zero_grad()
+        out = forward(*x).view(-1)
+        loss = loss_function(out, y)
+        loss.backward()
+        optimizer.step()
+        loss_train += loss.item()
+    return loss_train
+
+
+@torch.no_grad()
+def evaluate(
+    model: torch.nn.Module,
+    loader: DataLoader,
+    scale_coeff: float,
+    forward: Optional[Callable[..., torch.Tensor]] = None,
+) -> Tuple[float, int]:
+    """
+    Compute the total absolute difference between predicted and real prices,
+    and the number of samples it covers.
+    """
+    forward = forward or model
+
+    total, count = 0.0, 0
+    model.eval()
+    for *x, y in loader:
+        out = forward(*x).view(-1)
+        total += (out * scale_coeff - y * scale_coeff).abs().sum().item()
+        count += len(y)
+    return total, count
+
+
+def fit(
+    model: torch.nn.Module,
+    loader_train: DataLoader,
+    loader_valid: DataLoader,
+    optimizer: torch.optim.Optimizer,
+    scale_coeff: float,
+    epochs: int,
+    forward: Optional[Callable[..., torch.Tensor]] = None,
+    loss_function: Optional[Callable[[torch.Tensor, torch.Tensor], torch.Tensor]] = None,
+    keep_best: bool = True,
+) -> Optional[float]:
+    """
+    Train a model for some epochs, evaluating it after each one.
+
+    If `keep_best` is set, the state with the lowest validation error is loaded
+    at the end. Returns the mean absolute validation error of the final state,
+    in EUR. The `forward` and `loss_function` are used like in `train_epoch`.
+    """
+    mae, best_mae, best_model_state = None, None, None
+    for epoch in range(epochs):
+        loss_train = train_epoch(model, loader_train, optimizer, scale_coeff, forward, loss_function)
+        total, count = evaluate(model, loader_valid, scale_coeff, forward)
+        mae = total / count
+
+        print(
+            f"Epoch {epoch}:\tmean train loss: {loss_train/len(loader_train):.5f}" +
+            f"\tmean valid difference: {mae:.2f} EUR"
+        )
+
+        if keep_best and (best_mae is None or mae < best_mae):
+            best_mae = mae
+            best_model_state = copy.deepcopy(model.state_dict())
+
+    if best_model_state is not None:
+        print(f"Loading state with mean valid difference: {best_mae:.2f} EUR")
+        model.load_state_dict(best_model_state)
+        return best_mae
+    return mae
@@ -2,7 +2,7 @@
 This module implements a model which handles visual and other types of inputs.
 """
 
-from typing import List
+from typing import List, Optional, Sequence
 
 import torch
 import torch.nn as nn
@@ -15,16 +15,49 @@ class VisualModel(nn.Module):
     This model is based on `SimpleModel` and adapted to ingest images.
     """
 
-    def __init__(self, input_size: int, vocab_lens: List[int], embedding_dim: int, hidden_sizes: List[int]):
+    def __init__(
+        self,
+        input_size: int,
+        vocab_lens: List[int],
+        embedding_dim: int,
+        hidden_sizes: List[int],
+        image_size: int = 128,
+        channels: Sequence[int] = (16, 32),
+        pool_size: Optional[int] = None,
+    ):
+        """
+        Build the model. By default, the visual branch matches the original
+        model, which flattens the whole output of the convolutions.
+
+        The visual branch is configured by the size of the (square) input
+        images, the number of channels of each convolutional block, and the
+        `pool_size`. If it is given, the output of the convolutions is average-
+        pooled to a `pool_size` x `pool_size` grid before the linear layer, which
+        makes that layer much smaller and independent of the image size. A
+        `pool_size` of 1 gives global average pooling.
+        """
         super().__init__()
 
-        INTERIM = 28800 # This parameter depends on the image size.
         VISUAL_FEATURES = 10
+        conv_blocks = []
+        prev_channels, side = 3, image_size
+        for out_channels in channels:
+            conv_blocks.append(VisualModel.conv_block(prev_channels, out_channels))
+            prev_channels, side = out_channels, (side - 2) // 2
+        assert side > 0, "the image size is too small for this many blocks"
+
+        if pool_size is None:
+            pooling = []
+            interim = prev_channels * side * side
+        else:
+            pooling = [nn.AdaptiveAvgPool2d(pool_size)]
+            interim = prev_channels * pool_size * pool_size
+
         self.conv = nn.Sequential(
-            VisualModel.conv_block(3, 16),
-            VisualModel.conv_block(16, 32),
+            *conv_blocks,
+            *pooling,
             nn.Flatten(),
-            nn.Linear(INTERIM, VISUAL_FEATURES),
+            nn.Linear(interim, VISUAL_FEATURES),
             nn.BatchNorm1d(VISUAL_FEATURES),
             nn.Dropout1d(0.5),
         )
@@ -57,16 +90,28 @@ class VisualModel(nn.Module):
         )
 
     def forward(self, inputs, indices, images):
-        all_inputs = inputs
+        # Process the images and combine their features with the other inputs.
+        visual_features = self.conv(images)
+        return self.combine(inputs, indices, visual_features)
 
-        # Convert the indices into embeddings and add them to the other inputs.
-        for i, emb_layer in enumerate(self.embeddings):
-            col_indices = emb_layer(indices[:, i])
-            all_inputs = torch.hstack((all_inputs, col_indices))
+    def combine(self, inputs, indices, visual_features):
+        """
+        Make predictions from visual features which were already computed by
+        `self.conv`.
 
-        # Process the images and add their features to the other inputs.
-        visual_features = self.conv(images)
+        This allows callers to run the convolutional layers only once for an
+        image which is shared by many inputs.
+        """
+        all_inputs = self.embed(inputs, indices)
         all_inputs = torch.hstack((all_inputs, visual_features))
 
         out = self.hidden_layers(all_inputs)
         return out
+
+    def embed(self, inputs, indices):
+        """Convert the indices into embeddings and add them to the other inputs."""
+        all_inputs = inputs
+        for i, emb_layer in enumerate(self.embeddings):
+            col_indices = emb_layer(indices[:, i])
+            all_inputs = torch.hstack((all_inputs, col_indices))
+        return all_inputs